@@ -2,42 +2,218 @@
 # GNU General Public License v3.0+
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import time
-import json
-from threading import Thread
-from github_client import repo
-from ci_checker import check_ci_errors_and_comment
-from github_ops import add_label, remove_label, post_or_update_comment, archive_old_comment
-from issue_utils import get_unprocessed_items, parse_component_name, file_exists, comment_with_link
-from config import PROCESSED_FILE
-
-processed = set()
-try:
-    with open(PROCESSED_FILE) as f:
-        processed = set(json.load(f))
-except Exception as e:
-    print(f"⚠️ Failed to load {PROCESSED_FILE}: {e}")
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from threading import Thread, Lock, Event
+from github_client import g, repo
+from ci_checker import check_ci_errors_and_comment, get_latest_runs
+from github_ops import sync_labels, post_or_update_comment, archive_old_comment
+from issue_utils import get_unprocessed_items, item_from_payload, item_fingerprint, needs_ci_check, parse_component_name, file_exists, comment_with_link
+from storage import load_json, save_json, append_json_line, load_json_lines
+from config import PROCESSED_FILE, PROCESSED_LOG, MAX_PROCESSED, MAX_JOURNAL, STATE_FILE, RECONCILE_INTERVAL, POLL_FALLBACK, PROCESS_WORKERS, LOW_RATE_LIMIT
+
+# Maps each handled issue/PR number to the fingerprint it had when last processed.
+# PROCESSED_FILE is a snapshot; items handled since are appended to the PROCESSED_LOG
+# journal one line at a time and folded into the snapshot once per reconciliation pass,
+# or by the webhook worker once the journal holds MAX_JOURNAL entries.
+# The map is kept in order of last processing, so the least recently handled items are
+# the ones dropped once it grows past MAX_PROCESSED.
+processed_lock = Lock()
+
+def load_processed():
+    """
+    Rebuild the processed map from the snapshot with the journal replayed on top, and
+    return it together with the number of journal entries not yet folded in.
+    """
+    data = load_json(PROCESSED_FILE, {})
+    if isinstance(data, list):
+        processed = dict.fromkeys(data)
+    else:
+        processed = {int(number): fingerprint for number, fingerprint in data.items()}
+    journal = load_json_lines(PROCESSED_LOG)
+    for number, fingerprint in journal:
+        processed.pop(number, None)
+        processed[number] = fingerprint
+    return processed, len(journal)
+
+processed, journal_size = load_processed()
+
+state = load_json(STATE_FILE, {})
+
+# The (event, action) pairs the bot reacts to; every other delivery is dropped on arrival.
+HANDLED_EVENTS = {
+    ("workflow_run", "completed"),
+    ("issues", "opened"),
+    ("issues", "reopened"),
+    ("pull_request", "opened"),
+    ("pull_request", "reopened"),
+}
+
+event_queue = queue.Queue()
+stop_event = Event()
+threads = []
+threads_lock = Lock()
+
+def save_processed():
+    """
+    Fold the journal into a fresh snapshot and start an empty journal, dropping the
+    least recently processed items beyond MAX_PROCESSED. Nothing is written while
+    the journal is empty.
+    """
+    global journal_size
+    with processed_lock:
+        if not journal_size:
+            return
+        while len(processed) > MAX_PROCESSED:
+            del processed[next(iter(processed))]
+        save_json(PROCESSED_FILE, processed)
+        open(PROCESSED_LOG, "w").close()
+        journal_size = 0
+
+def get_open_pulls(items):
+    """
+    List the open PRs once when several items need a CI check, so they are looked up
+    in a dict instead of fetched one request each. Returns an empty dict otherwise.
+    """
+    if sum(1 for i in items if i.pull_request and needs_ci_check(i)) < 2:
+        return {}
+    return {pr.number: pr for pr in repo.get_pulls(state="open")}
+
+def process_item(item, pulls=None, latest_runs=None):
+    """
+    Handle one issue or PR and record it as processed. Returns False when its CI could not
+    be judged yet; it is then left unrecorded so the next pass tries it again.
+    """
+    global journal_size
+    print(f"🔄 Processing #{item.number}...")
+    if item.pull_request and needs_ci_check(item):
+        pr = (pulls or {}).get(item.number) or repo.get_pull(item.number)
+        if not check_ci_errors_and_comment(pr, sync_labels, post_or_update_comment, archive_old_comment, latest_runs):
+            return False
+    fingerprint = item_fingerprint(item)
+    with processed_lock:
+        first_seen = item.number not in processed
+        processed.pop(item.number, None)
+        processed[item.number] = fingerprint
+        journal_size += 1
+    # The disk sync happens outside the lock so other workers do not queue behind it. A
+    # record racing a compaction is either in the new snapshot or replayed harmlessly.
+    append_json_line(PROCESSED_LOG, [item.number, fingerprint])
+    if first_seen:
+        component = parse_component_name(item.body or "")
+        if component:
+            path = f"plugins/modules/{component}.py"
+            if file_exists(path):
+                comment_with_link(repo.get_issue(item.number), path)
+    return True
+
+def pulls_for_run(run):
+    """
+    Return the open PRs a workflow run was triggered for. GitHub leaves pull_requests
+    empty for runs of PRs opened from forks, so those are found by their head branch.
+    """
+    if run.get("pull_requests"):
+        return [repo.get_pull(pull["number"]) for pull in run["pull_requests"]]
+    owner = ((run.get("head_repository") or {}).get("owner") or {}).get("login")
+    if not owner or not run.get("head_branch"):
+        return []
+    pulls = repo.get_pulls(state="open", head=f"{owner}:{run['head_branch']}")
+    return [pr for pr in pulls if pr.head.sha == run.get("head_sha")]
+
+def handle_event(event, payload):
+    """
+    Route a GitHub webhook event to the handler for the affected issue or PR.
+    """
+    action = payload.get("action")
+    if event == "workflow_run" and action == "completed":
+        for pr in pulls_for_run(payload["workflow_run"]):
+            check_ci_errors_and_comment(pr, sync_labels, post_or_update_comment, archive_old_comment)
+    elif event == "issues" and action in ("opened", "reopened"):
+        process_item(item_from_payload(payload["issue"]))
+    elif event == "pull_request" and action in ("opened", "reopened"):
+        process_item(item_from_payload(payload["pull_request"], pull_request=True))
+
+def worker_count():
+    """
+    Process items in parallel, but one at a time once the REST rate limit runs low.
+    """
+    remaining, _ = g.rate_limiting
+    return PROCESS_WORKERS if remaining > LOW_RATE_LIMIT else 1
+
+def event_worker():
+    print("📬 Webhook worker started...")
+    while not stop_event.is_set():
+        try:
+            event, payload = event_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            handle_event(event, payload)
+            # Without the reconciliation loop nothing else keeps the journal short.
+            if journal_size >= MAX_JOURNAL:
+                save_processed()
+        except Exception as e:
+            print(f"⚠️ Failed to handle '{event}' event: {e}")
+        finally:
+            event_queue.task_done()
+
+def reconcile():
+    """
+    Run one reconciliation pass over the items that changed since the previous one.
+    """
+    with processed_lock:
+        snapshot = dict(processed)
+    # After the first full listing only the open PRs and the issues updated since the
+    # previous pass are fetched; the one-minute overlap covers clock skew with GitHub.
+    scan_started = datetime.now(timezone.utc) - timedelta(minutes=1)
+    items = get_unprocessed_items(snapshot, since=state.get("last_scan"))
+    if items is not None:
+        # Each item is dominated by network waits, so several are handled at once.
+        # With several PRs to check, their PRs and workflow runs come from one listing each.
+        pulls = get_open_pulls(items)
+        latest_runs = get_latest_runs() if pulls else {}
+        failed = False
+        with ThreadPoolExecutor(max_workers=worker_count()) as pool:
+            futures = {pool.submit(process_item, item, pulls, latest_runs): item for item in items}
+            for future in as_completed(futures):
+                # One failing item must not end the pass for the others.
+                if future.exception():
+                    print(f"⚠️ Failed to process #{futures[future].number}: {future.exception()}")
+                    failed = True
+                elif not future.result():
+                    failed = True
+        save_processed()
+        # The timestamp only advances when every item went through, so a failed or
+        # not yet judged one is listed again by the next pass.
+        if not failed:
+            state["last_scan"] = scan_started.strftime("%Y-%m-%dT%H:%M:%SZ")
+            save_json(STATE_FILE, state)
 
 def bot_loop():
-    global processed
-    print("🤖 Bot loop started...")
-    while True:
-        for item in get_unprocessed_items(processed):
-            print(f"🔄 Processing #{item.number}...")
-            if item.pull_request:
-                pr = repo.get_pull(item.number)
-                check_ci_errors_and_comment(pr, add_label, remove_label, post_or_update_comment, archive_old_comment)
-            body = item.body or ""
-            component = parse_component_name(body)
-            if component:
-                path = f"plugins/modules/{component}.py"
-                if file_exists(path):
-                    comment_with_link(item, path)
-            processed.add(item.number)
-        with open(PROCESSED_FILE, "w") as f:
-            json.dump(list(processed), f)
-        print("⏳ Sleeping for 3 minutes...")
-        time.sleep(180)
+    print("🤖 Reconciliation loop started...")
+    while not stop_event.is_set():
+        # A network error outside the items, such as a timed out listing, ends only this
+        # pass; the next one starts over from the same timestamp.
+        try:
+            reconcile()
+        except Exception as e:
+            print(f"⚠️ Reconciliation pass failed: {e}")
+        print(f"⏳ Sleeping for {RECONCILE_INTERVAL // 60} minutes...")
+        stop_event.wait(RECONCILE_INTERVAL)
 
 def start_bot():
-    Thread(target=bot_loop).start()
+    """
+    Start the webhook worker and, unless POLL_FALLBACK is off, the reconciliation loop.
+    A second call is a no-op, so the bot never runs twice in one process and double-posts comments.
+    """
+    with threads_lock:
+        if threads:
+            return
+        targets = (event_worker, bot_loop) if POLL_FALLBACK else (event_worker,)
+        threads.extend(Thread(target=target, daemon=True) for target in targets)
+        for thread in threads:
+            thread.start()
+
+def stop_bot():
+    stop_event.set()
@@ -0,0 +1,47 @@
+# Copyright (c) 2025, Marco Noce <nce.marco@gmail.com>
+# GNU General Public License v3.0+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import hashlib
+from threading import Lock
+from storage import load_json, save_json
+from config import CI_CACHE_FILE
+
+MAX_ENTRIES = 200
+
+cache = load_json(CI_CACHE_FILE, {})
+cache_lock = Lock()
+
+def _run_key(run_id, run_attempt):
+    return f"{run_id}:{run_attempt}"
+
+def get_cached_snippets(run_id, run_attempt, head_sha):
+    """
+    Return the {job: snippet} mapping parsed earlier for this run attempt, or None
+    if it was never parsed or belongs to a different head commit.
+    """
+    key = _run_key(run_id, run_attempt)
+    with cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if entry["head_sha"] != head_sha:
+            del cache[key]
+            return None
+        return dict(entry["snippets"])
+
+def store_snippets(run_id, run_attempt, head_sha, snippets):
+    """
+    Remember the parsed snippets of a run attempt, keeping only the newest entries.
+    """
+    key = _run_key(run_id, run_attempt)
+    digest = hashlib.sha1(json.dumps(snippets, sort_keys=True).encode()).hexdigest()
+    with cache_lock:
+        entry = cache.get(key)
+        if entry and entry["head_sha"] == head_sha and entry["snippets_digest"] == digest:
+            return
+        cache[key] = {"head_sha": head_sha, "snippets_digest": digest, "snippets": snippets}
+        while len(cache) > MAX_ENTRIES:
+            del cache[next(iter(cache))]
+        save_json(CI_CACHE_FILE, cache)
@@ -2,123 +2,346 @@
 # GNU General Public License v3.0+
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import os
 import re
-import io
+import shutil
+import string
+import hashlib
 import zipfile
-import requests
-from github_client import repo
-from config import GITHUB_TOKEN
+import tempfile
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+from github_client import repo, session, graphql, conditional_get
+from ci_cache import get_cached_snippets, store_snippets
+from config import REPO_NAME, REQUEST_TIMEOUT
 
-def clean_line(line):
+_parse_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Characters of a job's snippets shown in the comment; the log scan stops once they are filled.
+SNIPPET_BUDGET = 1000
+SNIPPET_SEPARATOR = "\n\n---\n\n"
+_BLOCK_SIZE = 1 << 20
+
+# Any CSI escape sequence (colors, erase-line, cursor control), not only color codes.
+_ANSI_RE = re.compile(r"(?:\x1b|�)\[[0-?]*[ -/]*[@-~]")
+# Logs are scanned as raw bytes; the replacement character matches as its UTF-8 encoding.
+_ANSI_BYTES_RE = re.compile(_ANSI_RE.pattern.encode())
+# The step number prefix and the extension of a log file name, stripped in one pass.
+_FOLDER_NOISE_RE = re.compile(r"^\d+_|\.txt$")
+_DIGEST_RE = re.compile(r"<!-- ci-digest: ([0-9a-f]+) -->")
+ERROR_MARKERS = ("FAILED", "FATAL", "fatal", "ERROR", "error", "WARNING", "warning")
+_ERROR_MARKERS_BYTES = tuple(marker.encode() for marker in ERROR_MARKERS)
+# Matches a whole error line (optionally prefixed by its timestamp) in an ANSI-free buffer.
+# All markers are folded into one alternation so the buffer is walked once, not once per marker.
+_ERROR_LINE_RE = re.compile(
+    rb"^[ \t]*(?:\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+Z)?[ \t]*"
+    rb"((?:" + b"|".join(map(re.escape, _ERROR_MARKERS_BYTES)) + rb")[^\r\n]*)",
+    re.MULTILINE,
+)
+
+# The failed check runs of the PR head and its latest comments, fetched in one round trip.
+PR_CI_QUERY = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      comments(last: 20) { totalCount nodes { databaseId body } }
+      commits(last: 1) { nodes { commit { oid checkSuites(first: 50) { nodes {
+        databaseId
+        checkRuns(first: 100, filterBy: {conclusions: [FAILURE]}) { nodes { name } }
+      } } } } }
+    }
+  }
+}
+"""
+
+class _NormTable(dict):
+    """
+    str.translate table that keeps lowercase ASCII letters and digits and turns every
+    other character, including non-ASCII ones, into an underscore.
+    """
+    def __missing__(self, codepoint):
+        return "_"
+
+_NORM_KEEP = set(string.ascii_lowercase + string.digits)
+_NORM_TABLE = _NormTable({c: chr(c) if chr(c) in _NORM_KEEP else "_" for c in range(128)})
+
+def normalize_key(name):
+    """
+    Reduce a job name or log folder name to the lowercase key used to pair them up.
+    """
+    return name.strip().lower().translate(_NORM_TABLE)
+
+def extract_error_snippets(stream, budget=SNIPPET_BUDGET):
+    """
+    Extracts the first error lines of a binary stream that start with FAILED, FATAL, ERROR or WARNING.
+    The log is read as bytes in fixed-size blocks cut at the last line break; each block with
+    a marker is stripped of ANSI sequences and scanned in one multiline pass, and only the
+    matched lines are decoded. Reading stops as soon as the joined snippets would fill
+    the `budget` characters shown in the comment.
+    """
+    snippets = []
+    size = 0
+    carry = b""
+    while size < budget:
+        data = stream.read(_BLOCK_SIZE)
+        if not data and not carry:
+            break
+        block = carry + data
+        carry = b""
+        if data:
+            # Hold the trailing partial line back so that a block always ends on a line break.
+            cut = block.rfind(b"\n") + 1
+            block, carry = block[:cut], block[cut:]
+        # A plain substring test is much cheaper than the ANSI sub and the regex scan,
+        # and most blocks of a log (setup, passing steps) contain no marker at all.
+        if not any(marker in block for marker in _ERROR_MARKERS_BYTES):
+            continue
+        for m in _ERROR_LINE_RE.finditer(_ANSI_BYTES_RE.sub(b"", block)):
+            snippet = m.group(1).decode("utf-8", errors="ignore").strip()
+            snippets.append(snippet)
+            size += len(snippet) + len(SNIPPET_SEPARATOR)
+            if size >= budget:
+                break
+    return snippets
+
+def download_logs(logs_url):
     """
-    Remove a leading ISO timestamp and ANSI escape sequences (including replacement characters)
-    from a log line.
+    Stream the logs archive into a temporary file instead of buffering it in memory.
+    Returns the open temporary file, or None if the download failed.
     """
-    cleaned = re.sub(r"^\s*\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d+Z\s*", "", line)
-    cleaned = re.sub(r"(?:\x1b|�)\[[0-9;]*[mK]", "", cleaned)
-    return cleaned.strip()
+    with session.get(logs_url, stream=True, timeout=REQUEST_TIMEOUT) as r:
+        if r.status_code != 200:
+            return None
+        tmp = tempfile.NamedTemporaryFile(suffix=".zip")
+        # Copy straight from the raw socket stream in large blocks rather than
+        # iterating small chunks in Python.
+        r.raw.decode_content = True
+        shutil.copyfileobj(r.raw, tmp, _BLOCK_SIZE)
+    tmp.flush()
+    return tmp
 
-def extract_error_snippets(lines):
+def parse_log_file(zip_file, info):
     """
-    Extracts all error lines from the log that start with FAILED, FATAL, or ERROR.
+    Decompress one log file from the zip archive and return its error snippets.
     """
-    candidates = []
-    for line in lines:
-        cleaned = clean_line(line)
-        if re.match(r'^(FAILED|FATAL|fatal|ERROR|error|WARNING|warning)', cleaned):
-            candidates.append(cleaned)
-    return candidates
+    with zip_file.open(info) as raw:
+        try:
+            return extract_error_snippets(raw)
+        except Exception as ex:
+            print(f"⚠️ Error reading {info.filename}: {ex}")
+            return []
 
-def match_job_for_log(normalized_folder, job_lookup):
+def parse_job_logs(archive_path, infos):
+    """
+    Return the snippets of the first of a job's log files that has any; the remaining
+    step logs of the job are never decompressed. Every call opens its own ZipFile,
+    so several jobs can be parsed in parallel.
+    """
+    with zipfile.ZipFile(archive_path) as zip_file:
+        for info in infos:
+            snippets = parse_log_file(zip_file, info)
+            if snippets:
+                return snippets
+    return []
+
+def build_job_matcher(job_lookup):
+    """
+    Precompute the substring lookups for job_lookup: one alternation of every key (a key
+    inside the folder name) and every key joined into one string (the folder name inside a key).
+    """
+    keys = sorted(job_lookup, key=len, reverse=True)
+    keys_re = re.compile("|".join(map(re.escape, keys))) if keys else None
+    return keys_re, "\n".join(keys)
+
+def match_job_for_log(normalized_folder, job_lookup, matcher=None):
     """
     Matches a normalized folder name from the log to a job in job_lookup.
+    An exact key is a single dict lookup; the substring search is only the fallback,
+    and runs as two C-level scans instead of a Python loop over the keys.
     """
-    for key, job in job_lookup.items():
-        if normalized_folder in key or key in normalized_folder:
-            return job
-    return None
+    job = job_lookup.get(normalized_folder)
+    if job is not None or not job_lookup:
+        return job
+    keys_re, joined_keys = matcher or build_job_matcher(job_lookup)
+    # Normalized names never contain a newline, so a hit lies within a single key.
+    pos = joined_keys.find(normalized_folder)
+    if pos != -1:
+        start = joined_keys.rfind("\n", 0, pos) + 1
+        end = joined_keys.find("\n", pos)
+        return job_lookup[joined_keys[start:end if end != -1 else None]]
+    m = keys_re.search(normalized_folder) if keys_re else None
+    return job_lookup[m.group()] if m else None
 
-def check_ci_errors_and_comment(pr, add_label, remove_label, post_comment, archive_comment):
+def extract_job_logs(archive_path, job_lookup):
+    """
+    Map each failed job to the combined error snippets of its log file in the archive.
+    """
+    # One pass over the central directory groups the log files by their top-level
+    # folder; every step log of a job shares it, so each folder is matched only once.
+    by_folder = {}
+    with zipfile.ZipFile(archive_path) as zip_file:
+        for info in zip_file.infolist():
+            if info.filename.endswith(".txt"):
+                by_folder.setdefault(info.filename.partition("/")[0], []).append(info)
+
+    matcher = build_job_matcher(job_lookup)
+    by_job = {}
+    for folder, infos in by_folder.items():
+        normalized_folder = normalize_key(_FOLDER_NOISE_RE.sub("", folder))
+        matched_job = match_job_for_log(normalized_folder, job_lookup, matcher)
+        if matched_job:
+            by_job.setdefault(matched_job, []).extend(infos)
+
+    # Jobs are parsed in parallel; within a job the files are read in order and the
+    # first one with snippets wins, so the scan stops there.
+    results = _parse_pool.map(parse_job_logs, repeat(archive_path), by_job.values())
+    return {job: SNIPPET_SEPARATOR.join(snippets) for job, snippets in zip(by_job, results) if snippets}
+
+def get_latest_runs():
+    """
+    Index the latest pull_request workflow run of each head commit from one listing of
+    the newest 100 runs, newest first. Returns an empty dict if the listing failed.
+    """
+    r = conditional_get(f"https://api.github.com/repos/{repo.full_name}/actions/runs?event=pull_request&per_page=100")
+    if r.status_code != 200:
+        return {}
+    latest_runs = {}
+    for run in r.json().get("workflow_runs", []):
+        latest_runs.setdefault(run["head_sha"], run)
+    return latest_runs
+
+def check_ci_errors_and_comment(pr, sync_labels, post_comment, archive_comment, latest_runs=None):
     """
     Check CI logs for the PR, extract error snippets, post a comment with details,
-    and update labels accordingly.
+    and update labels accordingly. latest_runs is an optional index from get_latest_runs;
+    PRs missing from it fetch their own run. Returns False when the PR could not be judged
+    yet (CI still running, a failed request) and should be checked again later.
     """
     print(f"🔎 Checking CI logs for PR #{pr.number}...")
-    runs = repo.get_workflow_runs(event="pull_request", head_sha=pr.head.sha)
-    if runs.totalCount == 0:
-        print("❌ No CI runs found.")
-        return
+    latest_run = (latest_runs or {}).get(pr.head.sha)
+    if latest_run is None:
+        # Polling the runs of an unchanged head commit is answered with a free 304.
+        runs_url = (f"https://api.github.com/repos/{repo.full_name}/actions/runs"
+                    f"?event=pull_request&head_sha={pr.head.sha}&per_page=1")
+        r = conditional_get(runs_url)
+        if r.status_code != 200:
+            print("⚠️ Failed to fetch workflow runs")
+            return False
+        runs = r.json().get("workflow_runs", [])
+        if not runs:
+            print("❌ No CI runs found.")
+            return True
+        latest_run = runs[0]
 
-    latest_run = runs[0]
-    if latest_run.status != "completed":
+    if latest_run["status"] != "completed":
         print("⏳ CI is still running...")
-        return
+        return False
 
-    logs_url = latest_run.logs_url
-    headers = {"Authorization": f"Bearer {GITHUB_TOKEN}"}
-    r = requests.get(logs_url, headers=headers)
-    if r.status_code != 200:
-        print("⚠️ Failed to download logs")
-        return
+    # The failed check runs tell which jobs to report without touching the logs, so the
+    # multi-megabyte archive is only downloaded when there is something to show. The
+    # comments needed to spot an already reported result come with the same query,
+    # which is only sent once a completed run is known.
+    owner, name = REPO_NAME.split("/")
+    data = graphql(PR_CI_QUERY, {"owner": owner, "name": name, "number": pr.number})
+    if data is None:
+        print("⚠️ Failed to fetch check runs")
+        return False
+    pull = data["repository"]["pullRequest"]
+    comments = pull["comments"]
+    comment_bodies = [c["body"] for c in comments["nodes"]]
+
+    # The PR may have moved to a new head since it was listed; only the suite of the
+    # run being checked can tell whether its jobs passed.
+    suite = None
+    for commit in pull["commits"]["nodes"]:
+        if commit["commit"]["oid"] != pr.head.sha:
+            continue
+        for node in commit["commit"]["checkSuites"]["nodes"]:
+            if node["databaseId"] == latest_run["check_suite_id"]:
+                suite = node
+    if suite is None:
+        print(f"⚠️ Check suite of run {latest_run['id']} not found on the head of PR #{pr.number}")
+        return False
 
     job_lookup = {}
-    failed_jobs = set()
-    jobs_url = f"https://api.github.com/repos/{repo.full_name}/actions/runs/{latest_run.id}/jobs"
-    jr = requests.get(jobs_url, headers=headers)
-    if jr.status_code == 200:
-        for job in jr.json().get("jobs", []):
-            name = job["name"]
-            if job["conclusion"] == "failure":
-                key = re.sub(r"[^a-z0-9]", "_", name.lower())
-                job_lookup[key] = name
-                failed_jobs.add(name)
-    else:
-        print("⚠️ Failed to fetch job list")
-        return
-
-    if not failed_jobs:
+    for check_run in suite["checkRuns"]["nodes"]:
+        job_lookup[normalize_key(check_run["name"])] = check_run["name"]
+
+    if not job_lookup:
         print(f"✅ All jobs passed for PR #{pr.number}.")
-        archive_comment(pr)
-        remove_label(pr, "stale_ci")
-        remove_label(pr, "needs_revision")
-        add_label(pr, "success")
-        return
-
-    job_logs = {}
-    with zipfile.ZipFile(io.BytesIO(r.content)) as zip_file:
-        for file_name in zip_file.namelist():
-            if not file_name.endswith(".txt"):
-                continue
-            folder = file_name.split("/")[0]
-            normalized_folder = re.sub(r"^\d+_", "", folder).replace(".txt", "").strip().lower()
-            normalized_folder = re.sub(r"[^a-z0-9]", "_", normalized_folder)
-            matched_job = match_job_for_log(normalized_folder, job_lookup)
-            if not matched_job or matched_job in job_logs:
-                continue
-            with zip_file.open(file_name) as f:
-                try:
-                    content = f.read().decode("utf-8", errors="ignore")
-                except Exception as ex:
-                    print(f"⚠️ Error reading {file_name}: {ex}")
-                    continue
-                lines = content.splitlines()
-                snippets = extract_error_snippets(lines)
-                if snippets:
-                    combined_snippets = "\n\n---\n\n".join(snippets)
-                    job_logs[matched_job] = combined_snippets
+        archive_comment(pr, bot_comments(pr, comments))
+        sync_labels(pr, add={"success"}, remove={"stale_ci", "needs_revision"})
+        return True
+
+    run_id, run_attempt = latest_run["id"], latest_run["run_attempt"]
+    digest = ci_digest(run_id, run_attempt, job_lookup.values())
+    if reported_digest(comment_bodies) == digest:
+        print(f"🔁 Failures of run {run_id} already reported on PR #{pr.number}.")
+        sync_labels(pr, add={"stale_ci", "needs_revision"}, remove={"success"})
+        return True
+
+    job_logs = get_cached_snippets(run_id, run_attempt, pr.head.sha)
+    if job_logs:
+        print(f"♻️ Reusing parsed logs of run {run_id}")
+        report_failures(pr, job_logs, digest, sync_labels, post_comment, bot_comments(pr, comments))
+        return True
+
+    logs_file = download_logs(latest_run["logs_url"])
+    if logs_file is None:
+        print("⚠️ Failed to download logs")
+        return False
+
+    with logs_file:
+        job_logs = extract_job_logs(logs_file.name, job_lookup)
 
     if not job_logs:
         print("❌ Some jobs failed, but no valid error snippets found.")
-        return
+        return True
+
+    store_snippets(run_id, run_attempt, pr.head.sha, job_logs)
+    report_failures(pr, job_logs, digest, sync_labels, post_comment, bot_comments(pr, comments))
+    return True
 
-    comment_body = "🚨 **CI Test Failures Detected**\n\n"
+def ci_digest(run_id, run_attempt, failed_jobs):
+    """
+    Fingerprint a CI result by its run attempt and the names of its failed jobs.
+    """
+    parts = [str(run_id), str(run_attempt)] + sorted(f"{job}:failure" for job in failed_jobs)
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+def reported_digest(comment_bodies):
+    """
+    Return the CI digest embedded in the bot's latest failure comment, if any.
+    """
+    bot_comments = [body for body in comment_bodies if "CI Test Failures Detected" in body]
+    if not bot_comments or "<details>" in bot_comments[-1]:
+        return None
+    match = _DIGEST_RE.search(bot_comments[-1])
+    return match.group(1) if match else None
+
+def bot_comments(pr, comments):
+    """
+    Narrow the PR comments the comment helpers must look at, using the latest comments
+    from the GraphQL query: the bot's last failure comment fetched by id, none when the
+    PR provably has none, or None to let the helpers list every comment.
+    """
+    failures = [c for c in comments["nodes"] if "CI Test Failures Detected" in c["body"]]
+    if failures:
+        return [pr.get_issue_comment(failures[-1]["databaseId"])]
+    if comments["totalCount"] <= len(comments["nodes"]):
+        return []
+    return None
+
+def report_failures(pr, job_logs, digest, sync_labels, post_comment, comments=None):
+    """
+    Post the per-job error snippets on the PR and flag it as needing revision.
+    The comment carries a hidden digest of the CI result so it is not rebuilt next time.
+    """
+    parts = ["🚨 **CI Test Failures Detected**\n\n"]
     for job, combined_snippet in job_logs.items():
-        comment_body += f"### ⚙️ {job}\n"
-        comment_body += f"```bash\n{combined_snippet[:1000]}\n```\n\n"
-
-    post_comment(pr, comment_body)
-    remove_label(pr, "success")
-    remove_label(pr, "stale_ci")
-    remove_label(pr, "needs_revision")
-    add_label(pr, "stale_ci")
-    add_label(pr, "needs_revision")
+        parts.append(f"### ⚙️ {job}\n```bash\n{combined_snippet[:SNIPPET_BUDGET]}\n```\n\n")
+    parts.append(f"<!-- ci-digest: {digest} -->\n")
+    comment_body = "".join(parts)
+
+    post_comment(pr, comment_body, comments)
+    sync_labels(pr, add={"stale_ci", "needs_revision"}, remove={"success"})
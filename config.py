@@ -5,5 +5,20 @@
 import os
 
 GITHUB_TOKEN = os.environ["GITHUB_TOKEN"]
+WEBHOOK_SECRET = os.environ.get("GITHUB_WEBHOOK_SECRET", "")
 REPO_NAME = "3A2DEV/ans2dev.general"
 PROCESSED_FILE = "processed.json"
+PROCESSED_LOG = "processed.log"
+MAX_PROCESSED = 10000
+# Entries the processed journal may hold before the webhook worker folds it into the snapshot.
+MAX_JOURNAL = 500
+STATE_FILE = "state.json"
+ETAG_FILE = "etags.json"
+CACHE_DIR = "cache"
+CI_CACHE_FILE = "ci_cache.json"
+RECONCILE_INTERVAL = 3600
+# Set POLL_FALLBACK=0 to rely on webhooks alone and skip the reconciliation loop.
+POLL_FALLBACK = os.environ.get("POLL_FALLBACK", "1") != "0"
+REQUEST_TIMEOUT = 30
+PROCESS_WORKERS = 8
+LOW_RATE_LIMIT = 500
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import os
+import pytest
 os.environ["GITHUB_TOKEN"] = "dummy_token"  # Set dummy token early
 
 # Patch the Github class before github_client is imported
@@ -27,7 +28,7 @@ def dummy_get_repo(self, repo_name):
     )
 
 class DummyGithub:
-    def __init__(self, token):
+    def __init__(self, token, **kwargs):
         self.token = token
     get_repo = dummy_get_repo
 
@@ -41,3 +42,11 @@ if "github_client" in sys.modules:
 
 # Now import github_client; it will use our patched github.Github
 import github_client
+
+@pytest.fixture(autouse=True)
+def isolated_state_files(tmp_path, monkeypatch):
+    """
+    Run each test from a scratch directory so the bot's JSON state and cache files
+    are never written into the repository.
+    """
+    monkeypatch.chdir(tmp_path)
@@ -2,8 +2,99 @@
 # GNU General Public License v3.0+
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import os
+import hashlib
+import requests
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from github import Github
-from config import GITHUB_TOKEN, REPO_NAME
+from storage import load_json, save_json, save_bytes
+from config import GITHUB_TOKEN, REPO_NAME, ETAG_FILE, CACHE_DIR, REQUEST_TIMEOUT, PROCESS_WORKERS
 
-g = Github(GITHUB_TOKEN)
+GRAPHQL_URL = "https://api.github.com/graphql"
+# URLs whose ETag and body are kept; the least recently refreshed ones are dropped first.
+MAX_ETAGS = 200
+
+# Listings (PR comments, open PRs) come back 100 per page instead of PyGithub's 30,
+# so walking them costs a third of the requests. The connection pool is sized for the
+# reconciliation workers that share the client.
+g = Github(GITHUB_TOKEN, per_page=100, pool_size=PROCESS_WORKERS)
 repo = g.get_repo(REPO_NAME)
+
+# One pooled keep-alive session for every raw HTTP call, so TLS handshakes with
+# api.github.com are paid once instead of per request.
+session = requests.Session()
+session.headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+session.headers["Accept"] = "application/vnd.github+json"
+session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+))
+
+etags = load_json(ETAG_FILE, {})
+etags_lock = Lock()
+
+def graphql(query, variables=None):
+    """
+    Run a query against the GitHub GraphQL API and return its data payload,
+    or None if the request failed.
+    """
+    try:
+        r = session.post(GRAPHQL_URL, json={"query": query, "variables": variables or {}}, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"⚠️ GraphQL request failed: {e}")
+        return None
+    if r.status_code != 200:
+        print(f"⚠️ GraphQL request failed with status {r.status_code}")
+        return None
+    result = r.json()
+    if result.get("errors"):
+        print(f"⚠️ GraphQL query returned errors: {result['errors']}")
+        return None
+    return result["data"]
+
+def _cache_path(url):
+    return os.path.join(CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + ".bin")
+
+def conditional_get(url):
+    """
+    GET a URL with If-None-Match set from the on-disk ETag cache. A 304 answer costs
+    no rate limit and is returned as a 200 response carrying the cached body.
+    """
+    cache_path = _cache_path(url)
+    with etags_lock:
+        etag = etags.get(url)
+    headers = {}
+    if etag and os.path.exists(cache_path):
+        headers["If-None-Match"] = etag
+    r = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if r.status_code == 304:
+        try:
+            with open(cache_path, "rb") as f:
+                r._content = f.read()
+        except FileNotFoundError:
+            # The body was evicted meanwhile; fetch it again unconditionally.
+            return session.get(url, timeout=REQUEST_TIMEOUT)
+        r.status_code = 200
+        return r
+    etag = r.headers.get("ETag")
+    if r.status_code == 200 and etag:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # A body lost in a crash only costs one full fetch, so it is not synced to disk.
+        save_bytes(cache_path, r.content, sync=False)
+        with etags_lock:
+            if etags.get(url) == etag:
+                return r
+            etags.pop(url, None)
+            etags[url] = etag
+            while len(etags) > MAX_ETAGS:
+                evicted = next(iter(etags))
+                del etags[evicted]
+                try:
+                    os.unlink(_cache_path(evicted))
+                except FileNotFoundError:
+                    pass
+            save_json(ETAG_FILE, etags)
+    return r
@@ -2,8 +2,15 @@
 # GNU General Public License v3.0+
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-def archive_old_comment(pr):
-    comments = list(pr.get_issue_comments())
+from github import GithubException
+
+def archive_old_comment(pr, comments=None):
+    """
+    Fold the bot's latest CI failure comment into a collapsed block. Callers that already
+    listed the PR comments pass them in to save a second paginated fetch.
+    """
+    if comments is None:
+        comments = list(pr.get_issue_comments())
     bot_comments = [c for c in comments if "CI Test Failures Detected" in c.body]
     if bot_comments:
         latest = bot_comments[-1]
@@ -16,13 +23,17 @@ def archive_old_comment(pr):
             latest.edit(archived)
             print("📦 Archived old CI comment")
 
-def post_or_update_comment(pr, new_body):
-    existing = list(pr.get_issue_comments())
+def post_or_update_comment(pr, new_body, comments=None):
+    """
+    Post the CI failure comment unless the bot's latest one already says the same.
+    Callers that already know the relevant comments pass them in to skip listing them all.
+    """
+    existing = list(pr.get_issue_comments()) if comments is None else comments
     bot_comments = [c for c in existing if "CI Test Failures Detected" in c.body]
     if bot_comments:
         last = bot_comments[-1]
         if new_body.strip() != last.body.strip():
-            archive_old_comment(pr)
+            archive_old_comment(pr, existing)
             pr.create_issue_comment(new_body)
             print("💬 Posted updated CI failures")
         else:
@@ -31,12 +42,21 @@ def post_or_update_comment(pr, new_body):
         pr.create_issue_comment(new_body)
         print("💬 Posted first CI failure comment")
 
-def add_label(item, label):
-    if label not in [l.name for l in item.labels]:
-        item.add_to_labels(label)
-        print(f"🏷️ Added label '{label}' to #{item.number}")
-
-def remove_label(item, label):
-    if label in [l.name for l in item.labels]:
-        item.remove_from_labels(label)
-        print(f"🏷️ Removed label '{label}' from #{item.number}")
+def sync_labels(item, add=(), remove=()):
+    """
+    Apply a label delta: the missing labels are added in one request and only the labels
+    present are removed. Labels are never replaced wholesale, since item.labels may be
+    minutes old and a label added meanwhile by someone else must survive.
+    """
+    current = {l.name for l in item.labels}
+    missing = sorted(set(add) - current)
+    present = sorted(set(remove) & current)
+    if missing:
+        item.add_to_labels(*missing)
+    for label in present:
+        try:
+            item.remove_from_labels(label)
+        except GithubException as e:
+            print(f"⚠️ Failed to remove label '{label}' from #{item.number}: {e.status}")
+    if missing or present:
+        print(f"🏷️ Updated labels on #{item.number}: +{missing} -{present}")
@@ -3,20 +3,232 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import re
-from github_client import repo
+import time
+import hashlib
+import requests
+from threading import Lock
+from dataclasses import dataclass, field
+from github_client import repo, session, graphql, conditional_get
+from config import REPO_NAME, RECONCILE_INTERVAL, REQUEST_TIMEOUT
 
-def get_unprocessed_items(processed):
-    issues = repo.get_issues(state="open", sort="created", direction="desc")
-    return [i for i in issues if i.number not in processed or any(l.name in ["success", "stale_ci", "needs_revision"] for l in i.labels)]
+_COMPONENT_RE = re.compile(r"###\s*Component Name\s*\n+([a-zA-Z0-9_]+)")
+
+LATEST_UPDATE_URL = (f"https://api.github.com/repos/{REPO_NAME}/issues"
+                     "?state=open&sort=updated&direction=desc&per_page=1")
+TREE_URL = f"https://api.github.com/repos/{REPO_NAME}/git/trees/main?recursive=1"
+
+# File paths of the main branch, listed once and refreshed every RECONCILE_INTERVAL.
+tree_paths = None
+tree_fetched = 0.0
+tree_lock = Lock()
+
+ITEM_FIELDS = """
+fragment IssueFields on Issue {
+  number body
+  labels(first: 20) { nodes { name } }
+}
+fragment PullFields on PullRequest {
+  number body headRefOid
+  labels(first: 20) { nodes { name } }
+  commits(last: 1) { nodes { commit { statusCheckRollup { state } } } }
+}
+"""
+
+# Issues and pull requests live in separate GraphQL connections; each one is
+# paged independently and dropped from the query once it is exhausted.
+OPEN_ITEMS_QUERY = ITEM_FIELDS + """
+query($owner: String!, $name: String!, $issuesCursor: String, $pullsCursor: String,
+      $withIssues: Boolean!, $withPulls: Boolean!) {
+  repository(owner: $owner, name: $name) {
+    issues(first: 100, after: $issuesCursor, states: OPEN,
+           orderBy: {field: CREATED_AT, direction: DESC}) @include(if: $withIssues) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...IssueFields }
+    }
+    pullRequests(first: 100, after: $pullsCursor, states: OPEN,
+                 orderBy: {field: CREATED_AT, direction: DESC}) @include(if: $withPulls) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...PullFields }
+    }
+  }
+}
+"""
+
+# The search connection returns the issues touched since a timestamp.
+UPDATED_ITEMS_QUERY = ITEM_FIELDS + """
+query($query: String!, $cursor: String) {
+  search(query: $query, type: ISSUE, first: 100, after: $cursor) {
+    pageInfo { hasNextPage endCursor }
+    nodes { __typename ...IssueFields ...PullFields }
+  }
+}
+"""
+
+@dataclass
+class Item:
+    number: int
+    body: str = ""
+    labels: set = field(default_factory=set)
+    pull_request: bool = False
+    head_sha: str = None
+    ci_state: str = None
+
+def _item_from_node(node, pull_request):
+    ci_state = None
+    if pull_request:
+        commits = node["commits"]["nodes"]
+        rollup = commits[0]["commit"]["statusCheckRollup"] if commits else None
+        ci_state = rollup["state"] if rollup else None
+    return Item(
+        number=node["number"],
+        body=node["body"] or "",
+        labels={l["name"] for l in node["labels"]["nodes"]},
+        pull_request=pull_request,
+        head_sha=node.get("headRefOid"),
+        ci_state=ci_state,
+    )
+
+def item_from_payload(data, pull_request=False):
+    """
+    Build an Item from the issue or pull_request object of a webhook payload.
+    """
+    return Item(
+        number=data["number"],
+        body=data.get("body") or "",
+        labels={l["name"] for l in data.get("labels", [])},
+        pull_request=pull_request,
+        head_sha=data.get("head", {}).get("sha"),
+    )
+
+def get_open_items(issues=True):
+    """
+    List every open PR and, unless issues is False, every open issue.
+    Returns None if the query failed.
+    """
+    owner, name = REPO_NAME.split("/")
+    variables = {
+        "owner": owner, "name": name,
+        "issuesCursor": None, "pullsCursor": None,
+        "withIssues": issues, "withPulls": True,
+    }
+    items = []
+    while variables["withIssues"] or variables["withPulls"]:
+        data = graphql(OPEN_ITEMS_QUERY, variables)
+        if data is None:
+            return None
+        repository = data["repository"]
+        for key, cursor, flag, pull_request in (
+            ("issues", "issuesCursor", "withIssues", False),
+            ("pullRequests", "pullsCursor", "withPulls", True),
+        ):
+            connection = repository.get(key)
+            if connection is None:
+                continue
+            items.extend(_item_from_node(node, pull_request) for node in connection["nodes"])
+            variables[cursor] = connection["pageInfo"]["endCursor"]
+            variables[flag] = connection["pageInfo"]["hasNextPage"]
+    return sorted(items, key=lambda i: i.number, reverse=True)
+
+def get_updated_items(since):
+    """
+    List the open issues updated at or after the given ISO timestamp,
+    or return None if the query failed.
+    """
+    variables = {"query": f"repo:{REPO_NAME} is:issue is:open updated:>={since}", "cursor": None}
+    items = []
+    while True:
+        data = graphql(UPDATED_ITEMS_QUERY, variables)
+        if data is None:
+            return None
+        search = data["search"]
+        items.extend(_item_from_node(node, node["__typename"] == "PullRequest") for node in search["nodes"])
+        if not search["pageInfo"]["hasNextPage"]:
+            break
+        variables["cursor"] = search["pageInfo"]["endCursor"]
+    return sorted(items, key=lambda i: i.number, reverse=True)
+
+def updated_since(since):
+    """
+    Tell whether any open issue or PR was updated at or after the given ISO timestamp.
+    The conditional REST request is answered with a free 304 while nothing changed,
+    so idle passes skip the GraphQL search. Errs on the side of True when it fails.
+    """
+    try:
+        r = conditional_get(LATEST_UPDATE_URL)
+    except requests.RequestException:
+        return True
+    if r.status_code != 200:
+        return True
+    latest = r.json()
+    return bool(latest) and latest[0]["updated_at"] >= since
+
+def item_fingerprint(item):
+    """
+    Summarize the parts of an item the bot reacts to: its labels, head commit and CI state.
+    """
+    state = f"{item.head_sha}|{item.ci_state}|{','.join(sorted(item.labels))}"
+    return hashlib.sha1(state.encode()).hexdigest()[:16]
+
+def get_unprocessed_items(processed, since=None):
+    """
+    Return the open items that are new or whose fingerprint changed since they were processed.
+    With a since timestamp only the issues updated after it are fetched. Open PRs are always
+    listed in full, because a finished CI run changes their rollup without moving updated_at.
+    Returns None when a listing failed, so the caller does not advance its timestamp past
+    missed items.
+    """
+    items = get_open_items(issues=not since)
+    if items is not None and since and updated_since(since):
+        issues = get_updated_items(since)
+        items = None if issues is None else sorted(items + issues, key=lambda i: i.number, reverse=True)
+    if items is None:
+        return None
+    return [i for i in items if processed.get(i.number) != item_fingerprint(i)]
+
+def needs_ci_check(item):
+    """
+    Decide from the status-check rollup whether the PR's CI logs are worth inspecting.
+    Failing PRs always are; green PRs only while their labels still need flipping.
+    """
+    if item.ci_state in ("FAILURE", "ERROR"):
+        return True
+    if item.ci_state == "SUCCESS":
+        return "success" not in item.labels or bool(item.labels & {"stale_ci", "needs_revision"})
+    return False
 
 def parse_component_name(body):
-    match = re.search(r"###\s*Component Name\s*\n+([a-zA-Z0-9_]+)", body)
+    match = _COMPONENT_RE.search(body)
     return match.group(1) if match else None
 
+def get_tree_paths():
+    """
+    Return the set of file paths on the main branch, or None if the tree could not be
+    listed in full. A refresh of an unchanged tree is answered with a free 304.
+    """
+    global tree_paths, tree_fetched
+    with tree_lock:
+        if tree_fetched and time.monotonic() - tree_fetched < RECONCILE_INTERVAL:
+            return tree_paths
+        r = conditional_get(TREE_URL)
+        tree = r.json() if r.status_code == 200 else {"truncated": True}
+        if tree.get("truncated"):
+            tree_paths = None
+        else:
+            tree_paths = {entry["path"] for entry in tree["tree"] if entry["type"] == "blob"}
+        tree_fetched = time.monotonic()
+        return tree_paths
+
 def file_exists(path):
+    """
+    Check a path against the cached tree listing. Without one, a HEAD request on the
+    contents API answers the question without downloading the file.
+    """
+    paths = get_tree_paths()
+    if paths is not None:
+        return path in paths
     try:
-        repo.get_contents(path)
-        return True
+        r = session.head(f"https://api.github.com/repos/{REPO_NAME}/contents/{path}", timeout=REQUEST_TIMEOUT)
+        return r.status_code == 200
     except Exception:
         return False
 
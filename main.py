@@ -2,8 +2,10 @@
 # GNU General Public License v3.0+
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from flask import Flask, jsonify
-from bot import start_bot
+from flask import Flask, jsonify, request
+from waitress import serve
+from bot import start_bot, stop_bot, event_queue, HANDLED_EVENTS
+from webhook import verify_signature, is_duplicate_delivery
 
 app = Flask(__name__)
 
@@ -16,6 +18,25 @@ def home():
         "color": "green"
     }), 200
 
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    if not verify_signature(request.get_data(), request.headers.get("X-Hub-Signature-256")):
+        return jsonify({"error": "invalid signature"}), 401
+    if is_duplicate_delivery(request.headers.get("X-GitHub-Delivery")):
+        return jsonify({"status": "duplicate"}), 200
+    event = request.headers.get("X-GitHub-Event", "")
+    if event == "ping":
+        return jsonify({"status": "pong"}), 200
+    payload = request.get_json(silent=True) or {}
+    if (event, payload.get("action")) not in HANDLED_EVENTS:
+        return jsonify({"status": "ignored"}), 200
+    event_queue.put((event, payload))
+    return jsonify({"status": "queued"}), 202
+
 if __name__ == "__main__":
     start_bot()
-    app.run(host="0.0.0.0", port=10000)
+    try:
+        # A production WSGI server; its worker threads absorb bursts of webhook deliveries.
+        serve(app, host="0.0.0.0", port=10000, threads=4)
+    finally:
+        stop_bot()
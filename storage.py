@@ -0,0 +1,69 @@
+# Copyright (c) 2025, Marco Noce <nce.marco@gmail.com>
+# GNU General Public License v3.0+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import json
+import tempfile
+
+def load_json(path, default):
+    """
+    Load a JSON state file, falling back to default when it is missing or unreadable.
+    """
+    try:
+        with open(path, "rb") as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        print(f"⚠️ Failed to load {path}: {e}")
+        return default
+
+def save_json(path, data):
+    """
+    Write a JSON state file in compact form.
+    """
+    save_bytes(path, json.dumps(data, separators=(",", ":")).encode())
+
+def save_bytes(path, data, sync=True):
+    """
+    Write a file atomically. The data goes to a temporary file that is synced and then
+    replaces the target, so a crash or a concurrent reader never sees a truncated or
+    empty file. Throwaway files that are cheap to rebuild pass sync=False.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def append_json_line(path, record):
+    """
+    Append one record to a JSON-lines journal, so only the new entry is written and synced.
+    """
+    with open(path, "a") as f:
+        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def load_json_lines(path):
+    """
+    Read back the records of a JSON-lines journal. A line torn by a crash mid-write is skipped.
+    """
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
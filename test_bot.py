@@ -4,6 +4,8 @@
 
 import io
 import zipfile
+import contextlib
+import pytest
 from types import SimpleNamespace
 
 def test_check_ci_errors_and_comment_failed(monkeypatch):
@@ -12,22 +14,21 @@ def test_check_ci_errors_and_comment_failed(monkeypatch):
     This simulates a workflow run with a logs zip containing an error line.
     """
     # Import the function under test from your ci_checker module.
+    import ci_checker
     from ci_checker import check_ci_errors_and_comment
     import github_client
-    import requests
-    from config import GITHUB_TOKEN  # In case needed for headers
 
     # Prepare a dictionary to capture the posted comment.
     captured_comment = {}
 
     # Dummy function to capture the comment body instead of posting to GitHub.
-    def dummy_post_or_update_comment(pr, new_body):
+    def dummy_post_or_update_comment(pr, new_body, comments=None):
         captured_comment['body'] = new_body
+        captured_comment['comments'] = comments
 
     # Dummy no-op functions for label updates and archiving.
-    dummy_add_label = lambda pr, label: None
-    dummy_remove_label = lambda pr, label: None
-    dummy_archive_comment = lambda pr: None
+    dummy_sync_labels = lambda pr, add=(), remove=(): None
+    dummy_archive_comment = lambda pr, comments=None: None
 
     # Create a dummy PR object with minimal attributes.
     def dummy_create_issue_comment(body):
@@ -40,38 +41,45 @@ def test_check_ci_errors_and_comment_failed(monkeypatch):
         get_issue_comments=lambda: []
     )
 
-    # Prepare a dummy workflow run.
-    dummy_run = SimpleNamespace(
-        status="completed",
-        logs_url="https://dummy.url/logs",
-        id=123
-    )
+    # Prepare a dummy workflow run, as listed by the actions/runs endpoint.
+    dummy_run = {
+        "status": "completed",
+        "logs_url": "https://dummy.url/logs",
+        "id": 123,
+        "run_attempt": 1,
+        "check_suite_id": 456,
+    }
 
-    # Create a container that mimics the object returned by get_workflow_runs,
-    # which has a totalCount attribute and is list-like.
-    class DummyRuns:
-        def __init__(self, runs):
-            self.runs = runs
-            self.totalCount = len(runs)
-        def __iter__(self):
-            return iter(self.runs)
-        def __getitem__(self, index):
-            return self.runs[index]
-
-    dummy_runs = DummyRuns([dummy_run])
-
-    # Patch the repo's get_workflow_runs to return our DummyRuns container.
-    monkeypatch.setattr(
-        github_client.repo,
-        "get_workflow_runs",
-        lambda **kwargs: dummy_runs
-    )
+    # The GraphQL query returns one failed job of the run, a failure from another
+    # suite and the comments currently on the PR.
+    pr_comments = []
+    head_oid = ["dummy_sha"]
+    def dummy_graphql(query, variables=None):
+        suites = [
+            {"databaseId": 456, "checkRuns": {"nodes": [{"name": "Units (devel)"}]}},
+            {"databaseId": 789, "checkRuns": {"nodes": [{"name": "codecov/patch"}]}},
+        ]
+        return {"repository": {"pullRequest": {
+            "comments": {
+                "totalCount": len(pr_comments),
+                "nodes": [{"databaseId": i, "body": body} for i, body in enumerate(pr_comments)],
+            },
+            "commits": {"nodes": [{"commit": {"oid": head_oid[0], "checkSuites": {"nodes": suites}}}]},
+        }}}
+    monkeypatch.setattr(ci_checker, "graphql", dummy_graphql)
 
     # Create a dummy ZIP archive in memory containing a log file with an error.
     class DummyResponse:
         def __init__(self, content, status_code=200):
             self.content = content
             self.status_code = status_code
+            # The logs archive is copied from the raw body stream.
+            self.raw = io.BytesIO(content)
+        # The logs archive is downloaded with stream=True inside a with block.
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
         # We'll add a json method here just in case, though it won't be used for logs.
         def json(self):
             return {}
@@ -90,27 +98,26 @@ def test_check_ci_errors_and_comment_failed(monkeypatch):
     zip_bytes = zip_buffer.getvalue()
 
     # Define a custom dummy_requests_get to handle different URLs.
-    def dummy_requests_get(url, headers):
-        # If the URL is for the jobs endpoint, return a dummy JSON response.
-        if "/actions/runs/" in url and "/jobs" in url:
-            class DummyJobsResponse:
+    def dummy_requests_get(url, headers=None, **kwargs):
+        # If the URL is for the workflow runs endpoint, return a dummy JSON response.
+        if "/actions/runs" in url:
+            class DummyRunsResponse:
                 status_code = 200
+                headers = {}
                 def json(self):
-                    # Return a dummy jobs list with one job marked as failure.
-                    return {"jobs": [{"name": "Units (devel)", "conclusion": "failure"}]}
-            return DummyJobsResponse()
+                    return {"total_count": 1, "workflow_runs": [dummy_run]}
+            return DummyRunsResponse()
         else:
             # Otherwise, assume it's the logs URL and return our ZIP archive.
             return DummyResponse(zip_bytes, 200)
 
-    # Patch requests.get with our dummy_requests_get.
-    monkeypatch.setattr(requests, "get", dummy_requests_get)
+    # Patch the shared HTTP session with our dummy_requests_get.
+    monkeypatch.setattr(github_client.session, "get", dummy_requests_get)
 
     # Call the function under test with our dummy PR and dummy post/comment functions.
     check_ci_errors_and_comment(
         dummy_pr,
-        dummy_add_label,
-        dummy_remove_label,
+        dummy_sync_labels,
         dummy_post_or_update_comment,
         dummy_archive_comment
     )
@@ -119,3 +126,604 @@ def test_check_ci_errors_and_comment_failed(monkeypatch):
     comment_body = captured_comment.get('body', '')
     assert "FAILED: Test failed due to assertion" in comment_body, \
         f"Expected error snippet not found in comment: {comment_body}"
+    # The query showed the PR has no comments, so the helpers need not list them.
+    assert captured_comment['comments'] == []
+
+@pytest.fixture
+def ci_pr(monkeypatch):
+    """
+    A PR whose completed run has one failed job, with the GraphQL query and the HTTP
+    session stubbed. The PR comments and head commit seen by the query can be changed,
+    and the fetched URLs, queries and posted comments are recorded.
+    """
+    import ci_cache
+    import ci_checker
+    import github_client
+
+    monkeypatch.setattr(ci_cache, "cache", {})
+    env = SimpleNamespace(
+        comments=[], head="dummy_sha", fetched=[], queries=[], posted=[], labels=[],
+        run={"status": "completed", "logs_url": "https://dummy.url/logs",
+             "id": 123, "run_attempt": 1, "check_suite_id": 456},
+    )
+    env.pr = SimpleNamespace(number=1, head=SimpleNamespace(sha="dummy_sha"),
+                             get_issue_comments=lambda: pytest.fail("comments must not be listed"))
+    env.sync_labels = lambda pr, add=(), remove=(): env.labels.append(set(add))
+    env.post_comment = lambda pr, body, comments=None: env.posted.append(body)
+    env.archive_comment = lambda pr, comments=None: None
+
+    def dummy_graphql(query, variables=None):
+        env.queries.append(variables)
+        suite = {"databaseId": 456, "checkRuns": {"nodes": [{"name": "Units (devel)"}]}}
+        return {"repository": {"pullRequest": {
+            "comments": {
+                "totalCount": len(env.comments),
+                "nodes": [{"databaseId": i, "body": body} for i, body in enumerate(env.comments)],
+            },
+            "commits": {"nodes": [{"commit": {"oid": env.head, "checkSuites": {"nodes": [suite]}}}]},
+        }}}
+    monkeypatch.setattr(ci_checker, "graphql", dummy_graphql)
+
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w") as zf:
+        zf.writestr("units (devel).txt", "FAILED: Test failed due to assertion\n")
+
+    def dummy_get(url, **kwargs):
+        env.fetched.append(url)
+        if "/actions/runs" in url:
+            return SimpleNamespace(status_code=200, headers={}, json=lambda: {"workflow_runs": [env.run]})
+        # The logs archive is streamed from the raw body inside a with block.
+        return contextlib.nullcontext(SimpleNamespace(status_code=200, raw=io.BytesIO(zip_buffer.getvalue())))
+    monkeypatch.setattr(github_client.session, "get", dummy_get)
+
+    env.check = lambda **kwargs: ci_checker.check_ci_errors_and_comment(
+        env.pr, env.sync_labels, env.post_comment, env.archive_comment, **kwargs)
+    return env
+
+def test_check_ci_skips_logs_of_reported_result(ci_pr):
+    """
+    Test that once the failure comment with its digest is on the PR, the same CI result
+    neither downloads the logs again nor posts another comment.
+    """
+    assert ci_pr.check() is True
+    assert "https://dummy.url/logs" in ci_pr.fetched
+    ci_pr.comments.append(ci_pr.posted.pop())
+    ci_pr.fetched.clear()
+
+    assert ci_pr.check() is True
+    assert "https://dummy.url/logs" not in ci_pr.fetched
+    assert ci_pr.posted == []
+    assert ci_pr.labels[-1] == {"stale_ci", "needs_revision"}
+
+def test_check_ci_uses_batched_run(ci_pr):
+    """
+    Test that a run taken from the batched listing spares the per-PR runs request.
+    """
+    assert ci_pr.check(latest_runs={"dummy_sha": ci_pr.run}) is True
+    assert ci_pr.fetched == ["https://dummy.url/logs"]
+
+def test_check_ci_waits_for_running_run(ci_pr):
+    """
+    Test that a run still in progress is left for later without querying its check runs.
+    """
+    ci_pr.run["status"] = "in_progress"
+    assert ci_pr.check() is False
+    assert ci_pr.queries == [] and ci_pr.labels == [] and ci_pr.posted == []
+
+def test_check_ci_archives_outdated_comment_by_id(ci_pr):
+    """
+    Test that an outdated failure comment among the latest ones is fetched by its id,
+    archived and followed by the new result, without listing the PR comments.
+    """
+    import github_ops
+
+    old_comment = SimpleNamespace(body="🚨 **CI Test Failures Detected**\n\nold failure")
+    old_comment.edit = lambda body: setattr(old_comment, "body", body)
+    fetched_ids = []
+    ci_pr.pr.get_issue_comment = lambda comment_id: fetched_ids.append(comment_id) or old_comment
+    ci_pr.pr.create_issue_comment = ci_pr.posted.append
+    ci_pr.post_comment = github_ops.post_or_update_comment
+    ci_pr.archive_comment = github_ops.archive_old_comment
+    ci_pr.comments[:] = ["unrelated review comment", old_comment.body]
+
+    assert ci_pr.check() is True
+    assert fetched_ids == [1]
+    assert old_comment.body.startswith("<details>") and "old failure" in old_comment.body
+    assert "FAILED: Test failed due to assertion" in ci_pr.posted[0]
+
+def test_check_ci_leaves_moved_head_unjudged(ci_pr):
+    """
+    Test that once the PR head has moved past the listed commit, the run is neither
+    reported nor taken as green.
+    """
+    ci_pr.head = "newer_sha"
+    assert ci_pr.check() is False
+    assert ci_pr.labels == [] and ci_pr.posted == []
+
+def test_check_ci_reuses_cached_snippets(ci_pr):
+    """
+    Test that snippets parsed earlier for a run attempt are posted again without
+    downloading the logs, and that a new head commit invalidates them.
+    """
+    import ci_cache
+
+    ci_cache.store_snippets(123, 1, "dummy_sha", {"Units (devel)": "FAILED: cached failure"})
+    assert ci_pr.check(latest_runs={"dummy_sha": ci_pr.run}) is True
+    assert ci_pr.fetched == []
+    assert "FAILED: cached failure" in ci_pr.posted[0]
+
+    # The same run id seen on another head commit no longer matches the entry.
+    assert ci_cache.get_cached_snippets(123, 1, "other_sha") is None
+    assert ci_cache.get_cached_snippets(123, 1, "dummy_sha") is None
+
+def test_extract_error_snippets_across_block_boundaries(monkeypatch):
+    """
+    Test that error lines split across read blocks are still found whole, and that
+    reading stops once the character budget is filled.
+    """
+    import ci_checker
+
+    # A tiny block size forces every line to straddle a block boundary.
+    monkeypatch.setattr(ci_checker, "_BLOCK_SIZE", 7)
+    log = (
+        "2025-04-01T04:07:58.0000000Z setup done\n"
+        "2025-04-01T04:07:58.1000000Z \x1b[31mERROR: first failure ✗\x1b[0m\n"
+        "plain line\n"
+        "\x1b[2K\x1b[?25lFATAL: second failure"
+    ).encode()
+    assert ci_checker.extract_error_snippets(io.BytesIO(log)) == [
+        "ERROR: first failure ✗",
+        "FATAL: second failure",
+    ]
+    # Many short warnings do not crowd out the failure that follows them.
+    noisy = b"WARNING: deprecated\n" * 6 + b"FAILED: the real problem\n"
+    assert ci_checker.extract_error_snippets(io.BytesIO(noisy))[-1] == "FAILED: the real problem"
+    # Nothing past the first snippet would fit in a 10-character comment.
+    assert ci_checker.extract_error_snippets(io.BytesIO(log), budget=10) == ["ERROR: first failure ✗"]
+
+def test_match_job_for_log_substring_fallback():
+    """
+    Test that log folders match their job exactly or by a substring in either direction.
+    """
+    from ci_checker import match_job_for_log, normalize_key
+
+    jobs = ["Units (devel)", "Sanity (stable-2.17)", "Integration"]
+    job_lookup = {normalize_key(name): name for name in jobs}
+
+    assert match_job_for_log("units__devel_", job_lookup) == "Units (devel)"
+    # The folder name is a truncated job name.
+    assert match_job_for_log("sanity__stable", job_lookup) == "Sanity (stable-2.17)"
+    # The job name is contained in a longer folder name.
+    assert match_job_for_log("integration_ubuntu", job_lookup) == "Integration"
+    assert match_job_for_log("docs", job_lookup) is None
+    assert match_job_for_log("docs", {}) is None
+
+def test_webhook_verifies_signature_and_queues_event(monkeypatch):
+    """
+    Test that the webhook endpoint rejects unsigned payloads, queues signed ones
+    and ignores redelivered or unhandled events.
+    """
+    import hmac
+    import hashlib
+    import json
+    import webhook
+    from main import app
+    from bot import event_queue
+
+    monkeypatch.setattr(webhook, "WEBHOOK_SECRET", "s3cret")
+    client = app.test_client()
+
+    body = json.dumps({"action": "opened", "issue": {"number": 7}}).encode()
+    signature = "sha256=" + hmac.new(b"s3cret", body, hashlib.sha256).hexdigest()
+    headers = {
+        "X-GitHub-Event": "issues",
+        "X-GitHub-Delivery": "delivery-1",
+        "Content-Type": "application/json",
+    }
+
+    # A request without a valid signature must be refused.
+    resp = client.post("/webhook", data=body, headers={**headers, "X-Hub-Signature-256": "sha256=bad"})
+    assert resp.status_code == 401
+    assert event_queue.empty()
+
+    # A signed request is accepted and handed to the worker queue.
+    resp = client.post("/webhook", data=body, headers={**headers, "X-Hub-Signature-256": signature})
+    assert resp.status_code == 202
+    assert event_queue.get_nowait() == ("issues", {"action": "opened", "issue": {"number": 7}})
+
+    # The same delivery sent again is acknowledged but not queued twice.
+    resp = client.post("/webhook", data=body, headers={**headers, "X-Hub-Signature-256": signature})
+    assert resp.status_code == 200
+    assert event_queue.empty()
+
+    # An action the bot does not react to is acknowledged without reaching the worker.
+    body = json.dumps({"action": "edited", "issue": {"number": 7}}).encode()
+    signature = "sha256=" + hmac.new(b"s3cret", body, hashlib.sha256).hexdigest()
+    headers["X-GitHub-Delivery"] = "delivery-2"
+    resp = client.post("/webhook", data=body, headers={**headers, "X-Hub-Signature-256": signature})
+    assert resp.status_code == 200
+    assert event_queue.empty()
+
+def test_get_unprocessed_items_pages_graphql(monkeypatch):
+    """
+    Test that open issues and PRs are collected from paged GraphQL responses and
+    filtered down to items that are new or changed since they were processed.
+    """
+    import issue_utils
+
+    def labels(*names):
+        return {"nodes": [{"name": n} for n in names]}
+
+    def pr_node(number, state, *label_names):
+        return {
+            "number": number,
+            "body": None,
+            "headRefOid": f"sha{number}",
+            "labels": labels(*label_names),
+            "commits": {"nodes": [{"commit": {"statusCheckRollup": {"state": state}}}]},
+        }
+
+    pages = [
+        {"repository": {
+            "issues": {
+                "pageInfo": {"hasNextPage": True, "endCursor": "i1"},
+                "nodes": [{"number": 5, "body": "text", "labels": labels()}],
+            },
+            "pullRequests": {
+                "pageInfo": {"hasNextPage": False, "endCursor": "p1"},
+                "nodes": [pr_node(4, "FAILURE", "stale_ci"), pr_node(3, "SUCCESS", "success")],
+            },
+        }},
+        {"repository": {
+            "issues": {
+                "pageInfo": {"hasNextPage": False, "endCursor": "i2"},
+                "nodes": [{"number": 1, "body": "old", "labels": labels()}],
+            },
+        }},
+    ]
+    calls = []
+
+    def dummy_graphql(query, variables):
+        calls.append(dict(variables))
+        return pages[(len(calls) - 1) % len(pages)]
+
+    monkeypatch.setattr(issue_utils, "graphql", dummy_graphql)
+
+    items = issue_utils.get_unprocessed_items({})
+
+    # The second request only asks for the issues connection that still has pages.
+    assert calls[1]["withIssues"] and not calls[1]["withPulls"]
+    assert calls[1]["issuesCursor"] == "i1"
+    assert [i.number for i in items] == [5, 4, 3, 1]
+    assert items[1].pull_request and items[1].head_sha == "sha4"
+    # A failing PR needs its logs inspected; a green PR already labelled does not.
+    assert issue_utils.needs_ci_check(items[1])
+    assert not issue_utils.needs_ci_check(items[2])
+
+    # Items processed in their current state are skipped; #4 changed since.
+    processed = {i.number: issue_utils.item_fingerprint(i) for i in items}
+    processed[4] = "outdated"
+    del processed[5]
+    items = issue_utils.get_unprocessed_items(processed)
+    assert [i.number for i in items] == [5, 4]
+
+def test_get_unprocessed_items_since_uses_search(monkeypatch):
+    """
+    Test that an incremental pass searches for recently updated issues only, while
+    open PRs are listed on every pass so a finished CI run is noticed.
+    """
+    import issue_utils
+
+    calls = []
+    rollup = [None]
+
+    def dummy_graphql(query, variables):
+        calls.append(dict(variables))
+        if "query" in variables:
+            return {"search": {
+                "pageInfo": {"hasNextPage": False, "endCursor": None},
+                "nodes": [{"__typename": "Issue", "number": 9, "body": "", "labels": {"nodes": []}}],
+            }}
+        return {"repository": {"pullRequests": {
+            "pageInfo": {"hasNextPage": False, "endCursor": None},
+            "nodes": [{
+                "number": 8, "body": "", "headRefOid": "abc",
+                "labels": {"nodes": [{"name": "stale_ci"}]},
+                "commits": {"nodes": [{"commit": {"statusCheckRollup": rollup[0]}}]},
+            }],
+        }}}
+
+    monkeypatch.setattr(issue_utils, "graphql", dummy_graphql)
+    latest = {"updated_at": "2025-04-01T00:05:00Z"}
+    monkeypatch.setattr(issue_utils, "conditional_get", lambda url: SimpleNamespace(
+        status_code=200, json=lambda: [latest]))
+
+    items = issue_utils.get_unprocessed_items({}, since="2025-04-01T00:00:00Z")
+
+    assert len(calls) == 2
+    assert not calls[0]["withIssues"] and calls[0]["withPulls"]
+    assert "is:issue" in calls[1]["query"] and "updated:>=2025-04-01T00:00:00Z" in calls[1]["query"]
+    assert [(i.number, i.pull_request) for i in items] == [(9, False), (8, True)]
+    assert items[1].ci_state is None
+
+    # Nothing was updated after the timestamp, so the search is skipped; the PR whose
+    # CI finished meanwhile is still picked up.
+    processed = {i.number: issue_utils.item_fingerprint(i) for i in items}
+    assert issue_utils.get_unprocessed_items(processed, since="2025-04-02T00:00:00Z") == []
+    rollup[0] = {"state": "FAILURE"}
+    items = issue_utils.get_unprocessed_items(processed, since="2025-04-02T00:00:00Z")
+    assert [(i.number, i.ci_state) for i in items] == [(8, "FAILURE")]
+    assert len(calls) == 4
+
+    # A failed query is reported as None rather than an empty listing.
+    monkeypatch.setattr(issue_utils, "graphql", lambda query, variables: None)
+    assert issue_utils.get_unprocessed_items({}, since="2025-04-01T00:00:00Z") is None
+
+def test_conditional_get_reuses_body_on_304(monkeypatch):
+    """
+    Test that a repeated GET sends the stored ETag and that a 304 answer is
+    turned into a 200 carrying the cached body.
+    """
+    import github_client
+
+    sent_headers = []
+    def dummy_get(url, headers=None, **kwargs):
+        sent_headers.append(dict(headers or {}))
+        if headers and headers.get("If-None-Match") == '"v1"':
+            return SimpleNamespace(status_code=304, headers={}, _content=None)
+        return SimpleNamespace(status_code=200, headers={"ETag": '"v1"'}, content=b'{"total_count": 1}')
+
+    monkeypatch.setattr(github_client.session, "get", dummy_get)
+    monkeypatch.setattr(github_client, "etags", {})
+
+    first = github_client.conditional_get("https://api.github.com/repos/dummy/repo/actions/runs")
+    second = github_client.conditional_get("https://api.github.com/repos/dummy/repo/actions/runs")
+
+    assert first.status_code == 200
+    assert sent_headers == [{}, {"If-None-Match": '"v1"'}]
+    assert second.status_code == 200 and second._content == b'{"total_count": 1}'
+
+    # Past MAX_ETAGS the oldest URL is forgotten along with its cached body.
+    import os
+    monkeypatch.setattr(github_client, "MAX_ETAGS", 1)
+    github_client.conditional_get("https://api.github.com/repos/dummy/repo/issues")
+    assert list(github_client.etags) == ["https://api.github.com/repos/dummy/repo/issues"]
+    assert len(os.listdir("cache")) == 1
+
+def test_file_exists_uses_cached_tree(monkeypatch):
+    """
+    Test that module lookups are answered from one listing of the repository tree.
+    """
+    import issue_utils
+
+    fetched = []
+    def dummy_conditional_get(url):
+        fetched.append(url)
+        return SimpleNamespace(status_code=200, json=lambda: {"truncated": False, "tree": [
+            {"path": "plugins/modules", "type": "tree"},
+            {"path": "plugins/modules/foo.py", "type": "blob"},
+        ]})
+
+    monkeypatch.setattr(issue_utils, "conditional_get", dummy_conditional_get)
+    monkeypatch.setattr(issue_utils, "tree_paths", None)
+    monkeypatch.setattr(issue_utils, "tree_fetched", 0.0)
+
+    assert issue_utils.file_exists("plugins/modules/foo.py")
+    assert not issue_utils.file_exists("plugins/modules/bar.py")
+    assert fetched == [issue_utils.TREE_URL]
+
+def test_save_json_replaces_file_atomically():
+    """
+    Test that state files round-trip through the storage helpers and that no
+    temporary files are left next to them.
+    """
+    import os
+    from storage import load_json, save_json
+
+    assert load_json("state.json", {"empty": True}) == {"empty": True}
+    save_json("state.json", {"last_scan": "2025-04-01T00:00:00Z"})
+    save_json("state.json", {"last_scan": "2025-04-02T00:00:00Z"})
+    assert load_json("state.json", {}) == {"last_scan": "2025-04-02T00:00:00Z"}
+    assert os.listdir(".") == ["state.json"]
+
+def test_json_lines_journal_skips_torn_line():
+    """
+    Test that journal records are appended one per line and that a line cut short
+    by a crash is ignored when the journal is read back.
+    """
+    from storage import append_json_line, load_json_lines
+
+    assert load_json_lines("processed.log") == []
+    append_json_line("processed.log", [7, "abc"])
+    append_json_line("processed.log", [8, "def"])
+    with open("processed.log", "a") as f:
+        f.write('[9,"gh')
+    assert load_json_lines("processed.log") == [[7, "abc"], [8, "def"]]
+
+def test_pulls_for_run_finds_fork_pulls(monkeypatch):
+    """
+    Test that a workflow run from a fork, which GitHub sends without pull_requests,
+    is matched to its open PR by the fork's head branch and commit.
+    """
+    import bot
+
+    queries = []
+    def dummy_get_pulls(**kwargs):
+        queries.append(kwargs)
+        return [
+            SimpleNamespace(number=3, head=SimpleNamespace(sha="old_sha")),
+            SimpleNamespace(number=4, head=SimpleNamespace(sha="fork_sha")),
+        ]
+    monkeypatch.setattr(bot.repo, "get_pulls", dummy_get_pulls, raising=False)
+
+    run = {
+        "pull_requests": [],
+        "head_sha": "fork_sha",
+        "head_branch": "fix-module",
+        "head_repository": {"owner": {"login": "contributor"}},
+    }
+    assert [pr.number for pr in bot.pulls_for_run(run)] == [4]
+    assert queries == [{"state": "open", "head": "contributor:fix-module"}]
+
+def test_graphql_returns_none_on_timeout(monkeypatch):
+    """
+    Test that a stalled GraphQL request is reported as a failed query instead of
+    raising into the reconciliation loop.
+    """
+    import requests
+    import github_client
+
+    def dummy_post(url, **kwargs):
+        raise requests.Timeout("read timed out")
+    monkeypatch.setattr(github_client.session, "post", dummy_post)
+
+    assert github_client.graphql("query { viewer { login } }") is None
+
+def test_save_processed_only_writes_after_appends(monkeypatch):
+    """
+    Test that the processed snapshot is rewritten only when items were journaled
+    since the previous one, and that the journal is emptied when it is.
+    """
+    import os
+    import bot
+    from issue_utils import Item
+
+    monkeypatch.setattr(bot, "processed", {})
+    monkeypatch.setattr(bot, "journal_size", 0)
+
+    bot.save_processed()
+    assert not os.path.exists("processed.json")
+
+    bot.process_item(Item(number=7))
+    assert bot.journal_size == 1
+    bot.save_processed()
+    assert bot.load_json("processed.json", {}) == {"7": bot.item_fingerprint(Item(number=7))}
+    assert os.path.getsize("processed.log") == 0 and bot.journal_size == 0
+
+def test_sync_labels_applies_a_delta():
+    """
+    Test that sync_labels adds only missing labels in one call, removes only present
+    ones, and never touches labels it was not asked about.
+    """
+    from github_ops import sync_labels
+
+    calls = []
+    item = SimpleNamespace(
+        number=4,
+        labels=[SimpleNamespace(name="success"), SimpleNamespace(name="module")],
+        add_to_labels=lambda *labels: calls.append(("add", labels)),
+        remove_from_labels=lambda label: calls.append(("remove", label)),
+    )
+    sync_labels(item, add={"stale_ci", "needs_revision"}, remove={"success", "wip"})
+    assert calls == [("add", ("needs_revision", "stale_ci")), ("remove", "success")]
+
+    calls.clear()
+    sync_labels(item, add={"module"}, remove={"wip"})
+    assert calls == []
+
+def test_process_item_leaves_unjudged_pr_unrecorded(monkeypatch):
+    """
+    Test that a PR whose CI could not be judged yet is not journaled as processed,
+    so the next pass checks it again.
+    """
+    import bot
+    from issue_utils import Item
+
+    monkeypatch.setattr(bot, "processed", {})
+    monkeypatch.setattr(bot, "journal_size", 0)
+    monkeypatch.setattr(bot.repo, "get_pull", lambda number: SimpleNamespace(number=number), raising=False)
+    outcome = [False]
+    monkeypatch.setattr(bot, "check_ci_errors_and_comment", lambda *args: outcome[0])
+
+    item = Item(number=8, pull_request=True, head_sha="abc", ci_state="FAILURE")
+    assert bot.process_item(item) is False
+    assert bot.processed == {} and bot.journal_size == 0
+
+    outcome[0] = True
+    assert bot.process_item(item) is True
+    assert bot.processed == {8: bot.item_fingerprint(item)}
+
+def test_reconcile_keeps_timestamp_when_an_item_fails(monkeypatch):
+    """
+    Test that one item raising does not stop the others from being recorded, and that
+    last_scan does not advance past the failed item.
+    """
+    import os
+    import bot
+    from issue_utils import Item
+
+    monkeypatch.setattr(bot, "processed", {})
+    monkeypatch.setattr(bot, "journal_size", 0)
+    monkeypatch.setattr(bot, "state", {"last_scan": "2025-04-01T00:00:00Z"})
+    monkeypatch.setattr(bot, "worker_count", lambda: 2)
+    monkeypatch.setattr(bot, "get_unprocessed_items", lambda processed, since=None: [Item(number=2), Item(number=1)])
+
+    original = bot.process_item
+    def flaky_process_item(item, pulls=None, latest_runs=None):
+        if item.number == 1:
+            raise RuntimeError("boom")
+        return original(item, pulls, latest_runs)
+    monkeypatch.setattr(bot, "process_item", flaky_process_item)
+
+    bot.reconcile()
+
+    assert bot.state == {"last_scan": "2025-04-01T00:00:00Z"}
+    assert not os.path.exists("state.json")
+    assert bot.load_json("processed.json", {}) == {"2": bot.item_fingerprint(Item(number=2))}
+
+def test_processed_drops_least_recently_handled(monkeypatch):
+    """
+    Test that replaying the journal moves an item to the most recent end, and that
+    compaction drops the least recently handled items beyond MAX_PROCESSED.
+    """
+    import bot
+    from storage import save_json, append_json_line
+
+    save_json("processed.json", {"1": "a", "2": "b", "3": "c"})
+    append_json_line("processed.log", [1, "a2"])
+    processed, journal_size = bot.load_processed()
+    assert list(processed.items()) == [(2, "b"), (3, "c"), (1, "a2")]
+    assert journal_size == 1
+
+    monkeypatch.setattr(bot, "processed", processed)
+    monkeypatch.setattr(bot, "journal_size", journal_size)
+    monkeypatch.setattr(bot, "MAX_PROCESSED", 2)
+    bot.save_processed()
+    assert bot.load_processed() == ({3: "c", 1: "a2"}, 0)
+
+def test_get_open_pulls_lists_once_for_several_checks(monkeypatch):
+    """
+    Test that open PRs are listed in one request only when at least two items need a
+    CI check, and are then indexed by number.
+    """
+    import bot
+    from issue_utils import Item
+
+    listings = []
+    def dummy_get_pulls(**kwargs):
+        listings.append(kwargs)
+        return [SimpleNamespace(number=4), SimpleNamespace(number=3)]
+    monkeypatch.setattr(bot.repo, "get_pulls", dummy_get_pulls, raising=False)
+
+    failing = [Item(number=n, pull_request=True, ci_state="FAILURE") for n in (4, 3)]
+    assert bot.get_open_pulls(failing[:1] + [Item(number=5)]) == {}
+    assert listings == []
+    assert sorted(bot.get_open_pulls(failing)) == [3, 4]
+    assert listings == [{"state": "open"}]
+
+def test_get_latest_runs_keeps_newest_run_per_head(monkeypatch):
+    """
+    Test that the batched runs listing keeps only the newest run of each head commit
+    and yields an empty index when the request fails.
+    """
+    import ci_checker
+
+    runs = [{"id": 3, "head_sha": "a"}, {"id": 2, "head_sha": "b"}, {"id": 1, "head_sha": "a"}]
+    status = [200]
+    monkeypatch.setattr(ci_checker, "conditional_get", lambda url: SimpleNamespace(
+        status_code=status[0], json=lambda: {"workflow_runs": runs}))
+
+    latest = ci_checker.get_latest_runs()
+    assert {sha: run["id"] for sha, run in latest.items()} == {"a": 3, "b": 2}
+    status[0] = 502
+    assert ci_checker.get_latest_runs() == {}
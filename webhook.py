@@ -0,0 +1,38 @@
+# Copyright (c) 2025, Marco Noce <nce.marco@gmail.com>
+# GNU General Public License v3.0+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hmac
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from config import WEBHOOK_SECRET
+
+MAX_DELIVERIES = 1024
+
+_seen_deliveries = OrderedDict()
+_seen_lock = Lock()
+
+def verify_signature(body, signature):
+    """
+    Check the X-Hub-Signature-256 header against the HMAC-SHA256 of the raw request body.
+    """
+    if not WEBHOOK_SECRET or not signature:
+        return False
+    expected = "sha256=" + hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+def is_duplicate_delivery(delivery_id):
+    """
+    Remember the most recent delivery ids so redelivered events are only handled once.
+    """
+    if not delivery_id:
+        return False
+    with _seen_lock:
+        if delivery_id in _seen_deliveries:
+            _seen_deliveries.move_to_end(delivery_id)
+            return True
+        _seen_deliveries[delivery_id] = True
+        if len(_seen_deliveries) > MAX_DELIVERIES:
+            _seen_deliveries.popitem(last=False)
+    return False